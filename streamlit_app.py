@@ -9,10 +9,10 @@ Version: 0.2.2
 Date: 2024-11-29
 """
 
-import datetime
-import json
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
+import numpy as np
+import orjson
 import pandas as pd
 import plotly.express as px
 import streamlit as st
@@ -20,22 +20,49 @@ import streamlit as st
 # Set page config as the first Streamlit command
 st.set_page_config(page_title="Cost Tracker App", page_icon="💵")
 
+# pandas' dedicated ISO-8601 parser, applied only to strings shaped like the
+# naive timestamps datetime.isoformat() writes (fraction omitted when
+# microsecond == 0)
+TIMESTAMP_FORMAT = "ISO8601"
+TIMESTAMP_PATTERN = r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d+)?"
+# Costs are kept as int64 fixed-point amounts of 1e-8 USD, the precision the
+# cost tracker function quantizes to (Config.DECIMALS), so stored costs keep
+# every decimal the tracker wrote. Larger costs would overflow int64
+COST_SCALE = 100_000_000
+MAX_COST = np.iinfo(np.int64).max / COST_SCALE
+# Users beyond the top spenders are folded into a single "Other" bar
+TOP_USERS = 20
+# Number of individual processing errors listed in the summary message
+MAX_REPORTED_ERRORS = 5
+# Lightweight Plotly template; skips the heavier default styling
+PLOT_TEMPLATE = "simple_white"
+# Per-record token and image/search counts are stored as int32
+INT32_MAX = np.iinfo(np.int32).max
+RECORD_KEYS = ["timestamp", "model", "total_cost", "user", "input_tokens", "output_tokens", "image_count", "web_search_count", "type"]
+
 @st.cache_data
-def load_data(file: Any) -> Optional[List[Dict[str, Any]]]:
-    """Load data from a JSON file.
+def load_data(content: bytes) -> Optional[Dict[str, pd.DataFrame]]:
+    """Load and process cost data from the contents of a JSON file.
+
+    Caching on the raw file contents means the JSON is parsed, processed and
+    split by month only once per uploaded file, not on every rerun of the
+    script.
 
     Args:
-        file: A file-like object containing JSON data.
+        content: The raw bytes of a JSON file.
 
     Returns:
-        A list of dictionaries with cost records if the JSON is valid, otherwise None.
+        A dictionary mapping each month ("YYYY-MM") to its processed data if
+        the JSON is valid, otherwise None.
     """
+    # pd.read_json(orient="records") was measured slower here: it also builds
+    # Python dicts (via ujson) before constructing the DataFrame
     try:
-        data = json.load(file)
-        return data
-    except json.JSONDecodeError:
+        data = orjson.loads(content)
+    except orjson.JSONDecodeError:
         st.error("Invalid JSON file. Please upload a valid JSON file.")
         return None
+    return split_by_month(process_data(data))
 
 
 def process_data(data: List[Dict[str, Any]]) -> pd.DataFrame:
@@ -43,129 +70,252 @@ def process_data(data: List[Dict[str, Any]]) -> pd.DataFrame:
 
     Args:
         data: A list of dictionaries containing cost records, or a dictionary
-              with user emails as keys and lists of records as values.
+              with user emails as keys and lists of records as values. In the
+              latter case the records are tagged with their user in place.
 
     Returns:
         A pandas DataFrame with processed data.
     """
-    processed_data = []
-    
-    # Check if data is a dictionary (user email keys) or a list
+    # Problems are counted and reported once at the end; an st.error per bad
+    # record would re-render the page for every one of them. Only the first
+    # MAX_REPORTED_ERRORS are formatted, since only those are ever shown
+    skipped = 0
+    errors: List[str] = []
+
+    # Flatten {"user@email.com": [records...], ...} into a single record list
+    # tagged with the user, so both layouts share one processing path. Records
+    # are tagged in place rather than copied, so the parsed JSON is not held
+    # in memory twice while the DataFrame is built
     if isinstance(data, dict):
-        # Data structure: {"user@email.com": [records...], ...}
-        for user_email, records in data.items():
-            if not isinstance(records, list):
-                st.error(f"Expected a list of records for user {user_email}, got {type(records)}")
+        records = []
+        for user_email, user_records in data.items():
+            if not isinstance(user_records, list):
+                skipped += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append(f"Expected a list of records for user {user_email}, got {type(user_records)}")
                 continue
-            
-            for record in records:
-                try:
-                    timestamp = datetime.datetime.strptime(
-                        record["timestamp"], "%Y-%m-%dT%H:%M:%S.%f"
-                    )
-                    month = timestamp.strftime("%Y-%m")
-                    model = record["model"]
-                    cost = record["total_cost"]
-
-                    # Ensure cost is a float
-                    if isinstance(cost, str):
-                        cost = float(cost)
-
-                    total_tokens = record["input_tokens"] + record["output_tokens"]
-                    image_count = record.get("image_count", 0)
-                    web_search_count = record.get("web_search_count", 0)
-                    record_type = record.get("type", "chat_completion")
-
-                    processed_data.append(
-                        {
-                            "month": month,
-                            "model": model,
-                            "total_cost": cost,
-                            "user": user_email,
-                            "total_tokens": total_tokens,
-                            "image_count": image_count,
-                            "web_search_count": web_search_count,
-                            "type": record_type,
-                        }
-                    )
-                except KeyError as e:
-                    st.error(f"Missing key in record: {e}. Record: {record}")
-                    continue
-                except ValueError:
-                    st.error(f"Invalid cost or token value in record: {record}")
-                    continue
-                except Exception as e:
-                    st.error(f"An error occurred processing record for user {user_email}: {e}")
+            for record in user_records:
+                if not isinstance(record, dict):
+                    skipped += 1
+                    if len(errors) < MAX_REPORTED_ERRORS:
+                        errors.append(f"Expected a record object for user {user_email}, got {type(record)}: {record!r}")
                     continue
+                record["user"] = user_email
+                records.append(record)
     else:
         # Data structure: [records...] where each record has a "user" field
+        records = []
         for record in data:
-            try:
-                timestamp = datetime.datetime.strptime(
-                    record["timestamp"], "%Y-%m-%dT%H:%M:%S.%f"
-                )
-                month = timestamp.strftime("%Y-%m")
-                model = record["model"]
-                cost = record["total_cost"]
-                user_email = record["user"] # Get user email directly from the record
-
-                # Ensure cost is a float
-                if isinstance(cost, str):
-                    cost = float(cost)
-
-                total_tokens = record["input_tokens"] + record["output_tokens"]
-                image_count = record.get("image_count", 0)
-                web_search_count = record.get("web_search_count", 0)
-                record_type = record.get("type", "chat_completion")
-
-                processed_data.append(
-                    {
-                        "month": month,
-                        "model": model,
-                        "total_cost": cost,
-                        "user": user_email,
-                        "total_tokens": total_tokens,
-                        "image_count": image_count,
-                        "web_search_count": web_search_count,
-                        "type": record_type,
-                    }
-                )
-            except KeyError as e:
-                st.error(f"Missing key in record: {e}. Record: {record}")
-                continue
-            except ValueError:
-                st.error(f"Invalid cost or token value in record: {record}")
-                continue
-            except Exception as e:
-                st.error(f"An error occurred processing record: {record}. Error: {e}")
+            if not isinstance(record, dict):
+                skipped += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append(f"Expected a record object, got {type(record)}: {record!r}")
                 continue
+            records.append(record)
+
+    # Build the frame straight from the records and coerce every field in one
+    # vectorized pass; missing keys and invalid values become NaN/NaT
+    raw = pd.DataFrame(records, columns=RECORD_KEYS)
+    # The ISO8601 format also accepts UTC offsets, date-only and space
+    # separated values, and mixing naive and aware values makes to_datetime
+    # raise even with errors="coerce". Only the naive shape the tracker writes
+    # is parsed; everything else is invalid, as with the old strict format
+    timestamp_strings = raw["timestamp"].astype("string")
+    is_naive_iso = timestamp_strings.str.fullmatch(TIMESTAMP_PATTERN, na=False)
+    timestamps = pd.to_datetime(
+        timestamp_strings.where(is_naive_iso), format=TIMESTAMP_FORMAT, cache=True, errors="coerce"
+    )
+    total_cost = pd.to_numeric(raw["total_cost"], errors="coerce")
+    total_tokens = pd.to_numeric(raw["input_tokens"], errors="coerce") + pd.to_numeric(
+        raw["output_tokens"], errors="coerce"
+    )
 
-    if not processed_data:
+    valid = (
+        timestamps.notna()
+        & np.isfinite(total_cost)
+        & (total_cost.abs() < MAX_COST)
+        & np.isfinite(total_tokens)
+        & (total_tokens.abs() <= INT32_MAX)
+        & raw["model"].notna()
+        & raw["user"].notna()
+    )
+    skipped += int((~valid).sum())
+    errors.extend(
+        f"Missing or invalid fields in record: {records[position]}"
+        for position in np.flatnonzero(~valid.to_numpy())[: MAX_REPORTED_ERRORS - len(errors)]
+    )
+    raw = raw[valid]
+
+    if skipped:
+        shown = "\n".join(f"- {error}" for error in errors)
+        st.error(
+            f"{skipped} entries could not be processed and were skipped. "
+            f"First {min(skipped, MAX_REPORTED_ERRORS)}:\n{shown}"
+        )
+
+    # Truncating to datetime64[M] lets numpy format "YYYY-MM" without strftime;
+    # each distinct month is formatted once and its codes become a categorical.
+    # The low-cardinality string columns are categorical too, so groupbys
+    # compare integer codes instead of hashing strings. Per-record counts fit
+    # in int32, halving their memory; aggregations sum them as int64
+    codes, unique_months = pd.factorize(
+        timestamps[valid].to_numpy().astype("datetime64[M]")
+    )
+
+    df = pd.DataFrame(
+        {
+            "month": pd.Categorical.from_codes(codes, unique_months.astype(str)),
+            "model": raw["model"].astype("category"),
+            "total_cost": (total_cost[valid] * COST_SCALE).round().astype("int64"),
+            "user": raw["user"].astype("category"),
+            "total_tokens": total_tokens[valid].astype("int32"),
+            "image_count": to_int32_count(raw["image_count"]),
+            "web_search_count": to_int32_count(raw["web_search_count"]),
+            "type": raw["type"].fillna("chat_completion").astype("category"),
+        }
+    )
+
+    if df.empty:
         st.warning("No valid data found to process.")
-        # Return an empty DataFrame with expected columns to avoid downstream errors
-        return pd.DataFrame(columns=["month", "model", "total_cost", "user", "total_tokens", "image_count", "web_search_count", "type"])
 
-    return pd.DataFrame(processed_data)
+    return df
 
 
-def plot_data(data: pd.DataFrame, month: str) -> None:
-    """Plot the data for a specific month.
+def to_int32_count(values: pd.Series) -> pd.Series:
+    """Convert an optional count column to int32.
+
+    Missing, non-numeric, non-finite and out-of-range values become 0, so the
+    downcast can neither fail nor silently wrap around.
+
+    Args:
+        values: A pandas Series with the raw count values.
+
+    Returns:
+        A pandas Series of int32 counts.
+    """
+    counts = pd.to_numeric(values, errors="coerce")
+    in_range = np.isfinite(counts) & (counts.abs() <= INT32_MAX)
+    return counts.where(in_range, 0).astype("int32")
+
+
+def split_by_month(data: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """Split the processed data into one DataFrame per month.
+
+    Called from the cached load_data, so switching months is a dictionary
+    lookup instead of a full scan of the month column.
 
     Args:
         data: A pandas DataFrame containing processed data.
-        month: A string representing the month to filter data.
+
+    Returns:
+        A dictionary mapping each month ("YYYY-MM") to its rows.
     """
-    month_data = data[data["month"] == month]
+    return {
+        month: month_data
+        for month, month_data in data.groupby("month", observed=True, sort=False)
+    }
+
+
+def sum_by_category(
+    data: pd.DataFrame, key: str, columns: List[str]
+) -> pd.DataFrame:
+    """Sum columns per value of a categorical key column.
+
+    Equivalent to ``data.groupby(key, observed=True)[columns].sum()``, but
+    scatter-adds each column straight into one accumulator per category over
+    the integer category codes: ``np.add.at`` into int64 accumulators for
+    integer columns, ``np.bincount`` for float columns.
+
+    Args:
+        data: A pandas DataFrame whose key column is categorical.
+        key: The name of the categorical column to group by.
+        columns: The numeric columns to sum.
+
+    Returns:
+        A pandas DataFrame with the key column and one summed column per
+        entry of columns, restricted to categories present in data. Integer
+        columns are summed exactly as int64.
+    """
+    codes = data[key].cat.codes.to_numpy()
+    categories = data[key].cat.categories
+    observed = np.bincount(codes, minlength=len(categories)) > 0
+
+    sums = {key: categories[observed]}
+    for column in columns:
+        values = data[column].to_numpy()
+        if np.issubdtype(values.dtype, np.integer):
+            # bincount always adds in float64, which stops being exact past
+            # 2**53; integer columns are accumulated in int64 instead
+            totals = np.zeros(len(categories), dtype=np.int64)
+            np.add.at(totals, codes, values)
+        else:
+            totals = np.bincount(codes, weights=values, minlength=len(categories))
+        sums[column] = totals[observed]
+    return pd.DataFrame(sums)
+
 
+@st.cache_data
+def aggregate_month(
+    month_data: pd.DataFrame,
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Compute the per-month aggregations used by the plots.
+
+    Cached per month DataFrame, so switching back to an already viewed month
+    skips the groupby work.
+
+    Args:
+        month_data: A pandas DataFrame containing the processed data of one month.
+
+    Returns:
+        A tuple with the top 10 models by tokens, the top 10 models by cost and
+        the per-user totals.
+    """
+    # Scatter-add tokens and cost per model (one pass per column), then rank each
+    models_agg = sum_by_category(month_data, "model", ["total_tokens", "total_cost"])
+    month_data_models_tokens = models_agg[["model", "total_tokens"]].nlargest(
+        10, "total_tokens"
+    )
+    month_data_models_cost = models_agg[["model", "total_cost"]].nlargest(
+        10, "total_cost"
+    )
+
+    # Group by user and sum both total_cost, total_tokens, image_count, and web_search_count
+    month_data_users = sum_by_category(
+        month_data, "user", ["total_cost", "total_tokens", "image_count", "web_search_count"]
+    )
+    month_data_users = month_data_users.sort_values(by="total_cost", ascending=False)
+
+    # Convert the exact fixed-point sums back to USD only for display
+    month_data_models_cost = month_data_models_cost.assign(
+        total_cost=month_data_models_cost["total_cost"] / COST_SCALE
+    )
+    month_data_users = month_data_users.assign(
+        total_cost=month_data_users["total_cost"] / COST_SCALE
+    )
+
+    return month_data_models_tokens, month_data_models_cost, month_data_users
+
+
+def plot_data(month_data: pd.DataFrame, month: str) -> None:
+    """Plot the data for a specific month.
+
+    Args:
+        month_data: A pandas DataFrame containing the processed data of the month.
+        month: A string representing the month being plotted.
+    """
     if month_data.empty:
         st.error(f"No data available for {month}.")
         return
 
+    month_data_models_tokens, month_data_models_cost, month_data_users = (
+        aggregate_month(month_data)
+    )
+
     # ---------------------------------
     # Summary Metrics
     # ---------------------------------
     total_messages = len(month_data)
-    total_cost_month = month_data["total_cost"].sum()
+    total_cost_month = month_data["total_cost"].sum() / COST_SCALE
     total_tokens_month = month_data["total_tokens"].sum()
     total_images_month = month_data["image_count"].sum()
     total_searches_month = month_data["web_search_count"].sum()
@@ -187,76 +337,47 @@ def plot_data(data: pd.DataFrame, month: str) -> None:
     # ---------------------------------
     # Model Usage Bar Plot (Total Tokens)
     # ---------------------------------
-    month_data_models_tokens = (
-        month_data.groupby("model")["total_tokens"].sum().reset_index()
-    )
-    month_data_models_tokens = month_data_models_tokens.sort_values(
-        by="total_tokens", ascending=False
-    ).head(10)
     fig_models_tokens = px.bar(
         month_data_models_tokens,
         x="model",
         y="total_tokens",
         title=f"Top 10 Total Tokens Used by Model ({month})",
+        template=PLOT_TEMPLATE,
     )
     st.plotly_chart(fig_models_tokens, use_container_width=True)
 
     # ---------------------------------
     # Model Cost Bar Plot (Total Cost)
     # ---------------------------------
-    month_data_models_cost = (
-        month_data.groupby("model")["total_cost"].sum().reset_index()
-    )
-    month_data_models_cost = month_data_models_cost.sort_values(
-        by="total_cost", ascending=False
-    ).head(10)
     fig_models_cost = px.bar(
         month_data_models_cost,
         x="model",
         y="total_cost",
         title=f"Top 10 Total Cost by Model ({month})",
+        template=PLOT_TEMPLATE,
     )
     st.plotly_chart(fig_models_cost, use_container_width=True)
 
     # ---------------------------------
     # User Cost and Token Bar Plot
     # ---------------------------------
-    # Group by user and sum both total_cost, total_tokens, image_count, and web_search_count
-    month_data_users = (
-        month_data.groupby("user")[["total_cost", "total_tokens", "image_count", "web_search_count"]]
-        .sum()
-        .reset_index()
-    )
-    month_data_users = month_data_users.sort_values(by="total_cost", ascending=False)
-
-    # Calculate totals for cost, tokens, images, and searches
-    total_cost_sum = month_data_users["total_cost"].sum()
-    total_tokens_sum = month_data_users["total_tokens"].sum()
-    total_images_sum = month_data_users["image_count"].sum()
-    total_searches_sum = month_data_users["web_search_count"].sum()
-
-    # Create the 'Total' row DataFrame
-    total_row = pd.DataFrame(
-        {
-            "user": ["Total"],
-            "total_cost": [total_cost_sum],
-            "total_tokens": [total_tokens_sum],
-            "image_count": [total_images_sum],
-            "web_search_count": [total_searches_sum],
-        }
-    )
-
-    # Concatenate the original data with the 'Total' row
-    month_data_users = pd.concat([month_data_users, total_row], ignore_index=True)
-
-    # Plot only total cost for clarity, but keep tokens in the DataFrame
+    # Plot only total cost for clarity, but keep tokens in the DataFrame.
+    # month_data_users is sorted by cost, so only the top spenders get a bar
+    users_plot = month_data_users[["user", "total_cost"]].head(TOP_USERS)
+    if len(month_data_users) > TOP_USERS:
+        other_row = pd.DataFrame(
+            {
+                "user": ["Other"],
+                "total_cost": [month_data_users["total_cost"].iloc[TOP_USERS:].sum()],
+            }
+        )
+        users_plot = pd.concat([users_plot, other_row], ignore_index=True)
     fig_users = px.bar(
-        month_data_users[
-            month_data_users["user"] != "Total"
-        ],  # Exclude Total row from plot for better scale
+        users_plot,
         x="user",
         y="total_cost",
         title=f"Total Cost by User ({month})",
+        template=PLOT_TEMPLATE,
     )
     st.plotly_chart(fig_users, use_container_width=True)
 
@@ -265,13 +386,17 @@ def plot_data(data: pd.DataFrame, month: str) -> None:
     # ---------------------------------
     with st.expander("Show DataFrames"):
         st.subheader("Month Data")
-        st.dataframe(month_data)
+        st.dataframe(month_data.assign(total_cost=month_data["total_cost"] / COST_SCALE))
         st.subheader("Month Data Models Tokens")
         st.dataframe(month_data_models_tokens)
         st.subheader("Month Data Models Cost")
         st.dataframe(month_data_models_cost)
         st.subheader("Month Data Users")
         st.dataframe(month_data_users)
+        st.caption(
+            f"Totals: cost=${total_cost_month:.4f}, tokens={total_tokens_month:,}, "
+            f"images={int(total_images_month):,}, searches={int(total_searches_month):,}"
+        )
 
 
 def main():
@@ -293,15 +418,14 @@ def main():
     file = st.file_uploader("Upload a JSON file", type=["json"])
 
     if file is not None:
-        data = load_data(file)
-        if data is not None:
-            processed_data = process_data(data)
-            months = processed_data["month"].unique()
-            month = st.sidebar.selectbox("Select a month", months)
+        by_month = load_data(file.getvalue())
+        if by_month is not None:
+            month = st.sidebar.selectbox("Select a month", list(by_month))
+            month_data = by_month.get(month, pd.DataFrame())
             if st.button("Process Data"):
-                plot_data(processed_data, month)
+                plot_data(month_data, month)
             if st.sidebar.button("Plot Data"):
-                plot_data(processed_data, month)
+                plot_data(month_data, month)
 
 if __name__ == "__main__":
     main()